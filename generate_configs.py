@@ -1,3 +1,5 @@
+import functools
+import os
 import yaml
 from pathlib import Path
 
@@ -7,16 +9,36 @@ ENV_YAML = ROOT / "env.targets.yaml"
 PROMETHEUS_YML = ROOT / "monitoring-server/prometheus/config/prometheus.yml"
 FLUENT_CONF = ROOT / "monitoring-target/fluent-package/conf/fluent.conf"
 
+# Buffer type for the fluent-package forward output: "memory" or "file"
+FLUENT_BUFFER_TYPE = os.getenv("FLUENT_BUFFER_TYPE", "memory")
 
-# Load env.targets.yaml
+# Exporters scraped on every target: (job_name, port)
+EXPORTERS = [
+    ("node_exporter", 9100),
+    ("dcgm_exporter", 9400),
+    ("process_exporter", 9256),
+]
+
+# Use the LibYAML parser/emitter when PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+# Load env.targets.yaml (parsed again only when its mtime changes)
 def load_env():
     if not ENV_YAML.exists():
         raise FileNotFoundError(f"{ENV_YAML} not found.")
+    return _load_env_cached(ENV_YAML.stat().st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_env_cached(mtime_ns):
     with open(ENV_YAML, encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=YAML_LOADER)
 
 
 def generate_prometheus_yml(env):
+    target_labels = [(t["ip"], t["instance"]) for t in env["targets"]]
     # Base configuration
     prometheus = {
         "global": {"scrape_interval": "1s", "evaluation_interval": "1s"},
@@ -25,42 +47,31 @@ def generate_prometheus_yml(env):
                 "job_name": "prometheus",
                 "static_configs": [{"targets": ["localhost:9090"]}],
             },
+        ]
+        + [
             {
-                "job_name": "node_exporter",
-                "static_configs": [
-                    {
-                        "targets": [f"{t['ip']}:9100"],
-                        "labels": {"instance": t["instance"]},
-                    }
-                    for t in env["targets"]
-                ],
-            },
-            {
-                "job_name": "dcgm_exporter",
-                "static_configs": [
-                    {
-                        "targets": [f"{t['ip']}:9400"],
-                        "labels": {"instance": t["instance"]},
-                    }
-                    for t in env["targets"]
-                ],
-            },
-            {
-                "job_name": "process_exporter",
+                "job_name": job_name,
                 "static_configs": [
                     {
-                        "targets": [f"{t['ip']}:9256"],
-                        "labels": {"instance": t["instance"]},
+                        "targets": [f"{ip}:{port}"],
+                        "labels": {"instance": instance},
                     }
-                    for t in env["targets"]
+                    for ip, instance in target_labels
                 ],
-            },
+            }
+            for job_name, port in EXPORTERS
         ],
     }
     if not PROMETHEUS_YML.parent.exists():
         PROMETHEUS_YML.parent.mkdir(parents=True, exist_ok=True)
     with open(PROMETHEUS_YML, "w", encoding="utf-8") as f:
-        yaml.dump(prometheus, f, allow_unicode=True, sort_keys=False)
+        yaml.dump(
+            prometheus,
+            f,
+            Dumper=YAML_DUMPER,
+            allow_unicode=True,
+            sort_keys=False,
+        )
 
 
 def generate_fluent_conf(env):
@@ -73,6 +84,33 @@ def generate_fluent_conf(env):
         ]
     )
 
+    # Forward buffer: "memory" (default) avoids per-flush fsyncs of a buffer
+    # file; "file" survives restarts and uses larger, less frequent chunks.
+    if FLUENT_BUFFER_TYPE == "file":
+        buffer_settings = (
+            "    @type file\n"
+            "    path /fluentd/log/buffer/forward_audit\n"
+            "    flush_mode interval\n"
+            "    flush_interval 5s\n"
+            "    chunk_limit_size 8M\n"
+        )
+    else:
+        buffer_settings = (
+            "    @type memory\n"
+            "    flush_mode interval\n"
+            "    flush_interval 1s\n"
+            "    chunk_limit_size 1M\n"
+        )
+    buffer_block = (
+        "  <buffer>\n"
+        + buffer_settings
+        + "    flush_at_shutdown true\n"
+        "    retry_forever true\n"
+        "    queue_limit_length 128\n"
+        "    compress gzip\n"
+        "  </buffer>\n"
+    )
+
     # Fluentd configuration template
     # 1. Use 'logfmt' parser to automatically extract ALL parameters (a0, a1, arch, comm, exe, items, etc.)
     # 2. Use record_transformer to derive 'user' (preferring string UID) and 'args' (decoding proctitle)
@@ -134,31 +172,31 @@ def generate_fluent_conf(env):
     @type grep
     <exclude>
     key args
-    pattern /procstat_textfile\.py/
+    pattern /\\bprocstat_textfile\\.py\\b/
+    </exclude>
+    <exclude>
+    key exe
+    pattern /(?:^|\\/)process-exporter(?:$|\\s)/
+    </exclude>
+    <exclude>
+    key exe
+    pattern /(?:^|\\/)node_exporter(?:$|\\s)/
     </exclude>
     <exclude>
     key exe
-    pattern /process-exporter|node_exporter|dcgm-exporter/
+    pattern /(?:^|\\/)dcgm-exporter(?:$|\\s)/
     </exclude>
 </filter>
 
 <match go.audit.raw>
   @type forward
+  compress gzip
   send_timeout 60s
   recover_wait 10s
   hard_timeout 60s
   phi_failure_detector false
-  <buffer>
-    @type file
-    path /fluentd/log/buffer/forward_audit
-    flush_mode interval
-    flush_interval 1s
-    flush_at_shutdown true
-    retry_forever true
-    chunk_limit_size 1M
-    queue_limit_length 128
-  </buffer>
 """
+        + buffer_block
         + server_blocks
         + """
 </match>
@@ -1,31 +1,197 @@
 #!/usr/bin/env python3
+import atexit
+import ctypes
+import functools
+import glob
+import hashlib
+import heapq
 import os
+import pwd
+import queue
+import re
+import resource
+import shutil
 import time
 import sys
 import subprocess
-from typing import Dict, List, Tuple, Any
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple, Union, Any
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
 
 PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
 CLK_TCK = os.sysconf("SC_CLK_TCK")
 
 PROCFS_PATH = os.getenv("PROCFS_PATH", "/host/proc")
-
-
+# Write to a temp file and rename it into place. 0 rewrites the file in place,
+# so a scrape may read it empty or half-written; only for setups that accept
+# partial reads.
+ATOMIC_WRITE = os.getenv("ATOMIC_WRITE", "1") == "1"
+# Also emit VMS, thread count and open fd count per process.
+EMIT_EXTENDED = os.getenv("EMIT_EXTENDED", "0") == "1"
+
+MIB = 1024 * 1024
+# Read size for /proc/<pid>/* files; stat, statm and comm are far smaller.
+READ_SIZE = 8192
+
+# Metric name -> (scope, HELP text, value expression). "proc" metrics are
+# rendered from the process record `p`, "gpu" metrics from a GPU entry `g`.
+METRICS: Dict[str, Tuple[str, str, str]] = {
+    "proc_cpu_percent": (
+        "proc",
+        "CPU usage of the process in percent of one core.",
+        "{p.cpu_percent:.1f}",
+    ),
+    "proc_memory_rss_bytes": (
+        "proc",
+        "Resident set size of the process in bytes.",
+        "{p.rss}",
+    ),
+    "proc_memory_vms_bytes": (
+        "proc",
+        "Virtual memory size of the process in bytes.",
+        "{p.vms}",
+    ),
+    "proc_threads": (
+        "proc",
+        "Number of threads in the process.",
+        "{p.threads}",
+    ),
+    "proc_open_fds": (
+        "proc",
+        "Number of open file descriptors of the process.",
+        "{p.fds}",
+    ),
+    "proc_gpu_sm_percent": (
+        "gpu",
+        "GPU SM utilization of the process in percent.",
+        "{g['sm']}",
+    ),
+    "proc_gpu_mem_percent": (
+        "gpu",
+        "GPU memory controller utilization of the process in percent.",
+        "{g['mem']}",
+    ),
+    "proc_gpu_fb_mem_mib": (
+        "gpu",
+        "GPU framebuffer memory used by the process in MiB.",
+        "{g['fb']}",
+    ),
+}
+# Metrics whose value is None when it could not be read; the line is skipped.
+OPTIONAL_METRICS = {"proc_open_fds": "fds"}
+DEFAULT_METRICS = [
+    "proc_cpu_percent",
+    "proc_memory_rss_bytes",
+    "proc_gpu_sm_percent",
+    "proc_gpu_mem_percent",
+    "proc_gpu_fb_mem_mib",
+]
+EXTENDED_METRICS = ["proc_memory_vms_bytes", "proc_threads", "proc_open_fds"]
+
+# Comma separated metric names to emit; unknown names are ignored.
+ENABLED_METRICS = [
+    name
+    for name in (
+        m.strip()
+        for m in os.getenv(
+            "ENABLED_METRICS",
+            ",".join(DEFAULT_METRICS + (EXTENDED_METRICS if EMIT_EXTENDED else [])),
+        ).split(",")
+    )
+    if name in METRICS
+]
+GPU_METRICS_ENABLED = any(METRICS[m][0] == "gpu" for m in ENABLED_METRICS)
+
+# HELP/TYPE lines never change, so they are rendered once at import.
+_HEADER = "".join(
+    f"# HELP {name} {METRICS[name][1]}\n# TYPE {name} gauge\n"
+    for name in ENABLED_METRICS
+)
+
+# Per-process GPU entries are keyed by (pid, gpu index).
+GpuKey = Tuple[int, str]
+
+# NVML device handles, opened once in init_nvml() and reused every interval.
+_NVML_HANDLES: List[Any] = []
+# Last sample timestamp seen per device, for nvmlDeviceGetProcessUtilization.
+_NVML_LAST_TS: List[int] = []
+# Worker threads overlapping the per-PID /proc reads (the GIL is released
+# while blocked in open/read).
+WORKERS = int(os.getenv("WORKERS", "8"))
+# PIDs handed to a worker per task, to amortise the per-future overhead.
+PIDS_PER_TASK = 16
+_POOL = ThreadPoolExecutor(max_workers=max(1, WORKERS))
+
+# Persistent nvidia-smi children used when NVML is unavailable.
+_SMI_STREAM: Optional["NvidiaSmiStream"] = None
+
+# uid -> user name, filled on first sight by resolve_uid().
+UID_CACHE_MAX = 1024
+_uid_cache: Dict[int, str] = {}
+
+# pid -> (start time, comm from stat, name, username, exe, label set), with
+# name/username/exe sanitized.
+_identity_cache: Dict[int, Tuple[int, bytes, str, str, str, str]] = {}
+
+# pid -> open fd of /proc/<pid>, so per-file opens skip the path walk. Capped
+# well below RLIMIT_NOFILE.
+_dir_fds: Dict[int, int] = {}
+_NOFILE_SOFT = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+if _NOFILE_SOFT == resource.RLIM_INFINITY or _NOFILE_SOFT > 131072:
+    _NOFILE_SOFT = 131072
+MAX_DIR_FDS = _NOFILE_SOFT // 2
+
+# Digest of the last payload written by write_metrics().
+_last_digest: Optional[bytes] = None
+
+
+class _SanitizeTable(dict):
+    """str.translate() table keeping alnum and "_:-." and mapping the rest to "_".
+
+    Latin-1 is filled in at import; other code points are resolved on first use.
+    """
+
+    def __missing__(self, codepoint: int) -> str:
+        c = chr(codepoint)
+        value = c if c.isalnum() or c in "_:-." else "_"
+        self[codepoint] = value
+        return value
+
+
+_SANITIZE_TABLE = _SanitizeTable()
+for _cp in range(256):
+    _SANITIZE_TABLE.__missing__(_cp)
+del _cp
+
+
+# Process names, users and executables repeat across intervals.
+@functools.lru_cache(maxsize=4096)
 def sanitize(s: str) -> str:
     if not s:
         return ""
-    return "".join(c if c.isalnum() or c in ["_", ":", "-", "."] else "_" for c in s)[
-        :200
-    ]
+    return s[:200].translate(_SANITIZE_TABLE)
+
+
+HOSTNAME = sanitize(os.uname().nodename)
+INSTANCE_LABEL = f',instance="{HOSTNAME}"'
 
 
-def read_env() -> Tuple[int, str, int, int, float]:
+def read_env() -> Tuple[int, str, int, int, float, int]:
     interval = int(os.getenv("INTERVAL_SECONDS", "5"))
     out_dir = os.getenv("OUTPUT_DIR", "/textfile")
     top_n = int(os.getenv("TOP_N", "0"))
     min_rss = int(os.getenv("MIN_RSS_BYTES", "0"))
     min_cpu = float(os.getenv("MIN_CPU_PERCENT", "0"))
-    return interval, out_dir, top_n, min_rss, min_cpu
+    gpu_interval = int(
+        os.getenv("GPU_POLL_INTERVAL_SECONDS", str(max(5, interval)))
+    )
+    return interval, out_dir, top_n, min_rss, min_cpu, gpu_interval
 
 
 def ensure_dir(path: str):
@@ -35,185 +201,529 @@ def ensure_dir(path: str):
         pass
 
 
-def write_metrics(path: str, lines: List[str]):
-    tmp = path + ".tmp"
+def write_all(path: str, data: bytes):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+def write_metrics(path: str, text: str):
+    global _last_digest
+
+    data = text.encode()
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    # Unchanged content: only bump the mtime so staleness checks on
+    # node_textfile_mtime_seconds keep passing. Rewrite if the file is gone.
+    if digest == _last_digest:
+        try:
+            os.utime(path, None)
+            return
+        except OSError:
+            pass
     try:
-        with open(tmp, "w") as f:
-            for line in lines:
-                f.write(line + "\n")
-        os.replace(tmp, path)
+        if ATOMIC_WRITE:
+            tmp = path + ".tmp"
+            write_all(tmp, data)
+            os.replace(tmp, path)
+        else:
+            write_all(path, data)
+        _last_digest = digest
     except OSError:
         pass
 
 
-def load_uid_map() -> Dict[int, str]:
-    mapping = {}
-    try:
-        passwd_path = f"{PROCFS_PATH}/../etc/passwd"
-        if not os.path.exists(passwd_path):
-            passwd_path = "/etc/passwd"
-
-        with open(passwd_path, "r") as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                parts = line.split(":")
-                if len(parts) >= 3:
-                    try:
-                        uid = int(parts[2])
-                        user = parts[0]
-                        mapping[uid] = user
-                    except ValueError:
-                        continue
-    except Exception:
-        pass
-    return mapping
+def resolve_uid(uid: int) -> str:
+    name = _uid_cache.get(uid)
+    if name is None:
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = str(uid)
+        # Bounded: start over rather than grow with short-lived uids.
+        if len(_uid_cache) >= UID_CACHE_MAX:
+            _uid_cache.clear()
+        _uid_cache[uid] = name
+    return name
 
 
 def get_process_pids() -> List[str]:
-    pids = []
+    # Only PID directories in /proc are all digits, so no is_dir() needed.
     try:
-        with os.scandir(PROCFS_PATH) as it:
-            for entry in it:
-                if entry.is_dir() and entry.name.isdigit():
-                    pids.append(entry.name)
-    except Exception:
-        pass
-    return pids
+        names = os.listdir(PROCFS_PATH)
+    except OSError:
+        return []
+    return [name for name in names if name.isdigit()]
 
 
-def read_file_content(path: str) -> str:
+def read_file_content(path: str, dir_fd: Optional[int] = None) -> bytes:
+    # One unbuffered read: no TextIOWrapper, no decode, no fstat, and procfs
+    # fills the whole (small) file in a single call.
     try:
-        with open(path, "r") as f:
-            return f.read().strip()
-    except (FileNotFoundError, ProcessLookupError, PermissionError, OSError):
-        return ""
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC, dir_fd=dir_fd)
+    except OSError:
+        return b""
+    try:
+        return os.read(fd, READ_SIZE).strip()
+    except OSError:
+        return b""
+    finally:
+        os.close(fd)
+
+
+@dataclass(slots=True)
+class ProcInfo:
+    """Counters of one process; identity fields are filled after filtering."""
+
+    pid: int
+    comm: bytes
+    rss: int
+    cpu_ticks: int
+    start_time: int
+    vms: int
+    threads: int
+    cpu_percent: float = 0.0
+    name: str = ""
+    username: str = ""
+    exe: str = ""
+    labels: str = ""
+    fds: Optional[int] = None
+
+
+def get_process_numbers(pid: str, min_rss: int = 0) -> Optional[ProcInfo]:
+    pid_int = int(pid)
+
+    dir_fd = _dir_fds.get(pid_int)
+    if dir_fd is not None:
+        info = read_process_numbers(pid_int, dir_fd, min_rss)
+        if info is not None:
+            return info
+        # The held directory belongs to a process that exited (its pid may
+        # have been reused since); drop it and look the pid up again.
+        close_dir_fd(pid_int)
+
+    dir_fd = open_proc_dir(pid_int)
+    if dir_fd is None:
+        return None
+    info = read_process_numbers(pid_int, dir_fd, min_rss)
+    if info is not None and len(_dir_fds) < MAX_DIR_FDS:
+        _dir_fds[pid_int] = dir_fd
+    else:
+        os.close(dir_fd)
+    return info or None
+
+
+def open_proc_dir(pid: int) -> Optional[int]:
+    try:
+        return os.open(
+            f"{PROCFS_PATH}/{pid}", os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC
+        )
+    except OSError:
+        return None
 
 
-def get_process_info(pid: str, uid_map: Dict[int, str]) -> Dict[str, Any]:
-    proc_dir = f"{PROCFS_PATH}/{pid}"
+def read_process_numbers(
+    pid_int: int, dir_fd: int, min_rss: int
+) -> Union[ProcInfo, bool, None]:
+    """Read the counters of one process through its /proc/<pid> directory fd.
 
-    comm = read_file_content(f"{proc_dir}/comm")
-    if not comm:
-        return {}
+    Only statm and stat are read here; identity is resolved later, for the
+    processes that survive filtering. Returns None if the process is gone
+    and False if it is filtered out.
+    """
+    rss_bytes = 0
+    vms_bytes = 0
+    statm = read_file_content("statm", dir_fd)
+    if not statm:
+        return None
+    parts = statm.split()
+    if len(parts) >= 2:
+        try:
+            rss_pages = int(parts[1])
+            rss_bytes = rss_pages * PAGE_SIZE
+            vms_bytes = int(parts[0]) * PAGE_SIZE
+        except ValueError:
+            pass
+
+    # statm is a single short read; drop small processes before the rest.
+    if min_rss > 0 and rss_bytes < min_rss:
+        return False
+
+    stat_content = read_file_content("stat", dir_fd)
+    if not stat_content:
+        return None
+    total_time_ticks = 0
+    start_time = 0
+    num_threads = 0
+    stat_comm = b""
+    head, rpar, rest = stat_content.rpartition(b")")
+    if rpar:
+        stat_comm = head[head.find(b"(") + 1 :]
+        # Only fields up to starttime are needed; leave the tail unsplit.
+        fields = rest.split(None, 20)
+        if len(fields) >= 20:
+            try:
+                utime = int(fields[11])
+                stime = int(fields[12])
+                total_time_ticks = utime + stime
+                num_threads = int(fields[17])
+                start_time = int(fields[19])
+            except ValueError:
+                pass
+
+    return ProcInfo(
+        pid_int,
+        stat_comm,
+        rss_bytes,
+        total_time_ticks,
+        start_time,
+        vms_bytes,
+        num_threads,
+    )
+
+
+def resolve_process_identity(info: ProcInfo) -> bool:
+    """Fill name/username/exe/labels (and fds) into a filtered process entry.
+
+    Returns False if the process has no usable name and should be dropped.
+    """
+    dir_fd = _dir_fds.get(info.pid)
+    if dir_fd is not None:
+        return fill_process_identity(info, dir_fd)
+    # Not held (MAX_DIR_FDS reached): open it for this lookup only.
+    dir_fd = open_proc_dir(info.pid)
+    try:
+        return fill_process_identity(info, dir_fd)
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+
+def fill_process_identity(info: ProcInfo, dir_fd: Optional[int]) -> bool:
+    pid_int = info.pid
+    start_time = info.start_time
+    stat_comm = info.comm
 
-    cmdline_raw = read_file_content(f"{proc_dir}/cmdline")
-    cmd_parts = cmdline_raw.split("\0")
-    exe = comm
-    if len(cmd_parts) > 0 and cmd_parts[0]:
-        exe = cmd_parts[0]
+    if "proc_open_fds" in ENABLED_METRICS:
+        info.fds = count_open_fds(dir_fd)
+
+    # name/user/exe only change on exec, which also changes comm, so reuse
+    # them while (start time, comm) match.
+    cached = _identity_cache.get(pid_int)
+    if cached is not None and cached[0] == start_time and cached[1] == stat_comm:
+        info.name, info.username, info.exe, info.labels = cached[2:]
+        return True
+
+    # stat already carries comm, so /proc/<pid>/comm is never opened.
+    comm = stat_comm.strip().decode("utf-8", "replace")
+    if not comm:
+        return False
 
-    uid = "unknown"
+    cmdline_raw = b""
     username = "unknown"
+    if dir_fd is not None:
+        cmdline_raw = read_file_content("cmdline", dir_fd)
+        try:
+            username = resolve_uid(os.fstat(dir_fd).st_uid)
+        except OSError:
+            pass
+
+    argv0 = cmdline_raw.split(b"\0", 1)[0]
+    exe = argv0.decode("utf-8", "replace") if argv0 else comm
+
+    name, username, exe = sanitize(comm), sanitize(username), sanitize(exe)
+    labels = (
+        f'pid="{pid_int}",process="{name}",user="{username}",exe="{exe}"'
+        + INSTANCE_LABEL
+    )
+    _identity_cache[pid_int] = (start_time, stat_comm, name, username, exe, labels)
+    info.name, info.username, info.exe, info.labels = name, username, exe, labels
+    return True
+
+
+def count_open_fds(dir_fd: Optional[int]) -> Optional[int]:
+    if dir_fd is None:
+        return None
+    # fd/ of other users' processes is unreadable without CAP_SYS_PTRACE.
     try:
-        stat_info = os.stat(proc_dir)
-        uid_val = stat_info.st_uid
-        username = uid_map.get(uid_val, str(uid_val))
+        fd_dir = os.open("fd", os.O_RDONLY | os.O_DIRECTORY, dir_fd=dir_fd)
     except OSError:
-        pass
+        return None
+    try:
+        return len(os.listdir(fd_dir))
+    except OSError:
+        return None
+    finally:
+        os.close(fd_dir)
 
-    rss_bytes = 0
-    statm = read_file_content(f"{proc_dir}/statm")
-    if statm:
-        parts = statm.split()
-        if len(parts) >= 2:
-            try:
-                rss_pages = int(parts[1])
-                rss_bytes = rss_pages * PAGE_SIZE
-            except ValueError:
-                pass
 
-    stat_content = read_file_content(f"{proc_dir}/stat")
-    total_time_ticks = 0
-    if stat_content:
-        rpar_idx = stat_content.rfind(")")
-        if rpar_idx != -1:
-            rest = stat_content[rpar_idx + 1 :].strip()
-            fields = rest.split()
-            if len(fields) >= 14:
-                try:
-                    utime = int(fields[11])
-                    stime = int(fields[12])
-                    total_time_ticks = utime + stime
-                except ValueError:
-                    pass
-
-    return {
-        "pid": int(pid),
-        "name": sanitize(comm),
-        "username": sanitize(username),
-        "exe": sanitize(exe),
-        "rss": rss_bytes,
-        "cpu_ticks": total_time_ticks,
-    }
-
-
-def collect_gpu_metrics() -> Dict[int, List[Dict[str, int]]]:
-    metrics: Dict[str, Dict[str, int]] = {}
+def close_dir_fd(pid: int):
+    dir_fd = _dir_fds.pop(pid, None)
+    if dir_fd is not None:
+        os.close(dir_fd)
+
+
+def prune_pid_caches(live_pids: Set[int]):
+    for pid in [pid for pid in _identity_cache if pid not in live_pids]:
+        del _identity_cache[pid]
+    for pid in [pid for pid in _dir_fds if pid not in live_pids]:
+        close_dir_fd(pid)
+
+
+def map_chunked(fn, items: list) -> list:
+    """Run `fn` over `items` on the pool, PIDS_PER_TASK items per task."""
+    chunks = [items[i : i + PIDS_PER_TASK] for i in range(0, len(items), PIDS_PER_TASK)]
+    results = []
+    for chunk in _POOL.map(lambda chunk: [fn(item) for item in chunk], chunks):
+        results.extend(chunk)
+    return results
+
+
+def collect_process_infos(pids: List[str], min_rss: int) -> List[Optional[ProcInfo]]:
+    return map_chunked(lambda pid: get_process_numbers(pid, min_rss), pids)
+
+
+def resolve_identities(procs: List[ProcInfo]) -> List[ProcInfo]:
+    resolved = map_chunked(resolve_process_identity, procs)
+    return [p for p, ok in zip(procs, resolved) if ok]
+
+
+def init_nvml() -> bool:
+    if pynvml is None:
+        return False
     try:
-        out = subprocess.check_output(
-            ["nvidia-smi", "pmon", "-c", "1"], stderr=subprocess.DEVNULL, text=True
-        )
-        for line in out.splitlines():
-            line = line.strip()
-            if not line or line.startswith("#") or line.startswith("-"):
-                continue
-            parts = line.split()
-            if len(parts) < 8 or parts[1] == "-":
-                continue
-            try:
-                pid = int(parts[1])
-                gpu_idx = parts[0]
-                sm = int(parts[3]) if parts[3].isdigit() else 0
-                mem = int(parts[4]) if parts[4].isdigit() else 0
-                key = f"{pid}:{gpu_idx}"
+        pynvml.nvmlInit()
+    except pynvml.NVMLError:
+        return False
+    atexit.register(pynvml.nvmlShutdown)
+    try:
+        for i in range(pynvml.nvmlDeviceGetCount()):
+            _NVML_HANDLES.append(pynvml.nvmlDeviceGetHandleByIndex(i))
+            _NVML_LAST_TS.append(0)
+    except pynvml.NVMLError:
+        _NVML_HANDLES.clear()
+        _NVML_LAST_TS.clear()
+    return bool(_NVML_HANDLES)
+
+
+def nvml_compute_processes(handle) -> list:
+    """Compute processes on `handle` (pid, usedGpuMemory, ...).
+
+    Drivers older than the v3 entry point raise FunctionNotFound; they get
+    the v2 call, which the pinned binding does not wrap but which takes the
+    same nvmlProcessInfo_v2_t records.
+    """
+    try:
+        return pynvml.nvmlDeviceGetComputeRunningProcesses_v3(handle)
+    except pynvml.NVMLError_FunctionNotFound:
+        pass
+    # _nvmlGetFunctionPointer is private to the binding, but it is how its own
+    # wrappers resolve entry points; the loop below mirrors the v3 wrapper.
+    fn = pynvml._nvmlGetFunctionPointer("nvmlDeviceGetComputeRunningProcesses_v2")
+    count = ctypes.c_uint(0)
+    ret = fn(handle, ctypes.byref(count), None)
+    if ret == pynvml.NVML_SUCCESS:
+        return []
+    if ret != pynvml.NVML_ERROR_INSUFFICIENT_SIZE:
+        raise pynvml.NVMLError(ret)
+    # Leave room for processes started between the two calls.
+    count.value = count.value * 2 + 5
+    procs = (pynvml.c_nvmlProcessInfo_v2_t * count.value)()
+    ret = fn(handle, ctypes.byref(count), procs)
+    if ret != pynvml.NVML_SUCCESS:
+        raise pynvml.NVMLError(ret)
+    result = []
+    for i in range(count.value):
+        proc = pynvml.nvmlStructToFriendlyObject(procs[i])
+        # Same "not available" sentinel handling as the binding's wrappers.
+        if proc.usedGpuMemory == pynvml.NVML_VALUE_NOT_AVAILABLE_ulonglong.value:
+            proc.usedGpuMemory = None
+        result.append(proc)
+    return result
+
+
+def collect_gpu_metrics_nvml(metrics: Dict[GpuKey, Dict[str, Any]]):
+    for idx, handle in enumerate(_NVML_HANDLES):
+        gpu_idx = str(idx)
+
+        # Raises NVML_ERROR_NOT_FOUND when no samples arrived since last_ts.
+        try:
+            samples = pynvml.nvmlDeviceGetProcessUtilization(
+                handle, _NVML_LAST_TS[idx]
+            )
+        except pynvml.NVMLError:
+            samples = []
+        for sample in sorted(samples, key=lambda x: x.timeStamp):
+            key = (sample.pid, gpu_idx)
+            metrics[key] = {
+                "gpu": gpu_idx,
+                "pid": sample.pid,
+                "sm": sample.smUtil,
+                "mem": sample.memUtil,
+                "fb": 0,
+            }
+            _NVML_LAST_TS[idx] = max(_NVML_LAST_TS[idx], sample.timeStamp)
+
+        try:
+            procs = nvml_compute_processes(handle)
+        except pynvml.NVMLError:
+            procs = []
+        for proc in procs:
+            fb_mib = (proc.usedGpuMemory or 0) // MIB
+            key = (proc.pid, gpu_idx)
+            if key in metrics:
+                metrics[key]["fb"] = fb_mib
+            else:
                 metrics[key] = {
                     "gpu": gpu_idx,
-                    "pid": pid,
-                    "sm": sm,
-                    "mem": mem,
-                    "fb": 0,
+                    "pid": proc.pid,
+                    "sm": 0,
+                    "mem": 0,
+                    "fb": fb_mib,
                 }
-            except ValueError:
-                continue
-    except Exception:
-        pass
 
-    try:
-        out = subprocess.check_output(
-            [
-                "nvidia-smi",
-                "query-compute-apps",
-                "--format=csv,noheader,nounits",
-                "--query-compute-apps=pid,used_memory,index",
-            ],
-            stderr=subprocess.DEVNULL,
-            text=True,
+
+# Capture patterns for the pmon columns that are read; other columns are
+# matched as any token.
+PMON_FIELDS = {
+    b"gpu": rb"(?P<gpu>\d+)",
+    b"pid": rb"(?P<pid>\d+)",
+    b"sm": rb"(?P<sm>\d+|-)",
+    b"mem": rb"(?P<mem>\d+|-)",
+    b"fb": rb"(?P<fb>\d+|-)",
+}
+
+
+def compile_pmon_row(header: bytes) -> "re.Pattern[bytes]":
+    """Build the row pattern from a `# gpu pid type ...` header line.
+
+    The column order of `pmon -s um` differs between driver versions (fb
+    moved, ccpm/jpg/ofa were added), so it is taken from the header.
+    """
+    columns = header.lstrip(b"#").split()
+    if b"command" in columns:
+        columns = columns[: columns.index(b"command")]
+    return re.compile(
+        rb"\s*" + rb"\s+".join(PMON_FIELDS.get(c, rb"\S+") for c in columns)
+    )
+
+
+class PmonParser:
+    """Stateful line parser for `nvidia-smi pmon -s um` output.
+
+    Rows are ignored until a header has been seen; rows without a process
+    ("-" as pid) do not match. Columns missing from the header read as 0.
+    """
+
+    def __init__(self):
+        self.row: Optional["re.Pattern[bytes]"] = None
+
+    def __call__(self, line: bytes) -> Optional[Dict[str, Any]]:
+        if line.startswith(b"# gpu"):
+            self.row = compile_pmon_row(line)
+            return None
+        if self.row is None:
+            return None
+        m = self.row.match(line)
+        if m is None:
+            return None
+        # Groups exist only for the columns the header listed.
+        fields = m.groupdict(b"-")
+        gpu, pid, sm, mem, fb = (
+            fields.get(name, b"-") for name in ("gpu", "pid", "sm", "mem", "fb")
         )
-        for line in out.splitlines():
-            parts = [s.strip() for s in line.split(",")]
-            if len(parts) < 3:
-                continue
+        if b"-" in (gpu, pid):
+            return None
+        return {
+            "gpu": gpu.decode(),
+            "pid": int(pid),
+            "sm": 0 if sm == b"-" else int(sm),
+            "mem": 0 if mem == b"-" else int(mem),
+            "fb": 0 if fb == b"-" else int(fb),
+        }
+
+
+class NvidiaSmiStream:
+    """A long-lived nvidia-smi child in loop mode, parsed on a reader thread.
+
+    Rows are kept per (pid, gpu) with the time they were last reported, so a
+    snapshot only returns processes seen in the most recent samples.
+    """
+
+    def __init__(self, args: List[str], parse_line):
+        self.args = args
+        self.parse_line = parse_line
+        self.proc: Optional[subprocess.Popen] = None
+        self.rows: Dict[GpuKey, Tuple[float, Dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+
+    def ensure_running(self):
+        if self.proc is not None and self.proc.poll() is None:
+            return
+        try:
+            self.proc = subprocess.Popen(
+                self.args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError:
+            self.proc = None
+            return
+        threading.Thread(target=self._read, args=(self.proc,), daemon=True).start()
+
+    def _read(self, proc: subprocess.Popen):
+        for line in proc.stdout:
+            # The child is only respawned once it exits, so a row that fails
+            # to parse must not end this thread.
             try:
-                pid = int(parts[0])
-                fb_mib = int(parts[1])
-                gpu_idx = parts[2]
-                key = f"{pid}:{gpu_idx}"
-                if key in metrics:
-                    metrics[key]["fb"] = fb_mib
-                else:
-                    metrics[key] = {
-                        "gpu": gpu_idx,
-                        "pid": pid,
-                        "sm": 0,
-                        "mem": 0,
-                        "fb": fb_mib,
-                    }
-            except ValueError:
+                row = self.parse_line(line)
+            except Exception:
                 continue
-    except Exception:
-        pass
+            if row is None:
+                continue
+            with self.lock:
+                self.rows[(row["pid"], row["gpu"])] = (time.monotonic(), row)
+
+    def snapshot(self, max_age: float) -> List[Dict[str, Any]]:
+        cutoff = time.monotonic() - max_age
+        with self.lock:
+            self.rows = {k: v for k, v in self.rows.items() if v[0] >= cutoff}
+            return [dict(row) for _, row in self.rows.values()]
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+
+def collect_gpu_metrics_smi(metrics: Dict[GpuKey, Dict[str, Any]], interval: int):
+    # One pmon child reports utilization (u) and framebuffer memory (m) per
+    # process, so --query-compute-apps is not needed.
+    global _SMI_STREAM
+    if _SMI_STREAM is None:
+        if shutil.which("nvidia-smi") is None:
+            return
+        pmon_delay = max(1, min(10, interval))
+        _SMI_STREAM = NvidiaSmiStream(
+            ["nvidia-smi", "pmon", "-s", "um", "-d", str(pmon_delay)],
+            PmonParser(),
+        )
+        atexit.register(_SMI_STREAM.stop)
+
+    # Respawn the child if it exited (driver reload, GPU reset, ...).
+    _SMI_STREAM.ensure_running()
+    for row in _SMI_STREAM.snapshot(2 * max(interval, 1)):
+        metrics[(row["pid"], row["gpu"])] = row
+
+
+def collect_gpu_metrics(interval: int) -> Dict[int, List[Dict[str, int]]]:
+    metrics: Dict[GpuKey, Dict[str, Any]] = {}
+    if _NVML_HANDLES:
+        collect_gpu_metrics_nvml(metrics)
+    else:
+        collect_gpu_metrics_smi(metrics, interval)
 
     result: Dict[int, List[Dict[str, int]]] = {}
     for m in metrics.values():
@@ -224,90 +734,194 @@ def collect_gpu_metrics() -> Dict[int, List[Dict[str, int]]]:
     return result
 
 
-def build_prom_lines(
-    proc_list: List[Dict[str, Any]], gpu_map: Dict[int, List[Dict[str, int]]]
-) -> List[str]:
-    lines = []
+def top_key(p: "ProcInfo") -> Tuple[float, int]:
+    # TOP_N ranking: CPU percent, ties broken by RSS.
+    return p.cpu_percent, p.rss
+
+
+def compile_renderer(metrics: List[str]):
+    """Generate render(p, gpus, out) that appends the lines for `metrics`.
+
+    The function is built once at startup as straight-line code, so metrics
+    that are switched off cost nothing per process.
+    """
+    proc = [m for m in metrics if METRICS[m][0] == "proc"]
+    gpu = [m for m in metrics if METRICS[m][0] == "gpu"]
+
+    src = ["def render(p, gpus, out):", "    labels = p.labels"]
+    always = [m for m in proc if m not in OPTIONAL_METRICS]
+    if always:
+        src.append("    out.append(")
+        for m in always:
+            src.append('        f"' + m + "{{{labels}}} " + METRICS[m][2] + '\\n"')
+        src.append("    )")
+    for m in proc:
+        if m in OPTIONAL_METRICS:
+            src.append(f"    if p.{OPTIONAL_METRICS[m]} is not None:")
+            src.append(
+                '        out.append(f"' + m + "{{{labels}}} " + METRICS[m][2] + '\\n")'
+            )
+    if gpu:
+        src.append("    for g in gpus:")
+        src.append("""        gpu_labels = f'{labels},gpu="{g["gpu"]}"'""")
+        src.append("        out.append(")
+        for m in gpu:
+            src.append(
+                '            f"' + m + "{{{gpu_labels}}} " + METRICS[m][2] + '\\n"'
+            )
+        src.append("        )")
+
+    namespace: Dict[str, Any] = {}
+    exec(compile("\n".join(src) + "\n", "<render>", "exec"), namespace)
+    return namespace["render"]
+
+
+render_process = compile_renderer(ENABLED_METRICS)
+
+
+def build_prom_text(
+    proc_list: List["ProcInfo"], gpu_map: Dict[int, List[Dict[str, int]]]
+) -> str:
+    blocks = [_HEADER]
+    for p in proc_list:
+        render_process(p, gpu_map.get(p.pid, ()), blocks)
+    return "".join(blocks)
 
-    hostname = sanitize(os.uname().nodename)
 
-    for p in proc_list:
-        pid = p["pid"]
-        labels = f'pid="{pid}",process="{p["name"]}",user="{p["username"]}",exe="{p["exe"]}",instance="{hostname}"'
+@dataclass
+class Snapshot:
+    """One interval's worth of collected data, handed from collector to writer."""
+
+    procs: List["ProcInfo"]
+    gpu_map: Dict[int, List[Dict[str, int]]]
+
 
-        lines.append(f"proc_cpu_percent{{{labels}}} {p['cpu_percent']:.1f}")
-        lines.append(f"proc_memory_rss_bytes{{{labels}}} {p['rss']}")
+def publish(snapshots: "queue.Queue[Snapshot]", snapshot: Snapshot):
+    # The queue holds one snapshot; if the writer is behind, replace the
+    # stale one instead of blocking the collector.
+    try:
+        snapshots.put_nowait(snapshot)
+    except queue.Full:
+        try:
+            snapshots.get_nowait()
+        except queue.Empty:
+            pass
+        snapshots.put_nowait(snapshot)
 
-        for g in gpu_map.get(pid, []):
-            gpu_labels = f'{labels},gpu="{g.get("gpu", "unknown")}"'
-            lines.append(f'proc_gpu_sm_percent{{{gpu_labels}}} {g.get("sm", 0)}')
-            lines.append(f'proc_gpu_mem_percent{{{gpu_labels}}} {g.get("mem", 0)}')
-            lines.append(f'proc_gpu_fb_mem_mib{{{gpu_labels}}} {g.get("fb", 0)}')
 
-    return lines
+def write_loop(snapshots: "queue.Queue[Snapshot]", path: str):
+    while True:
+        snapshot = snapshots.get()
+        text = build_prom_text(snapshot.procs, snapshot.gpu_map)
+        write_metrics(path, text)
 
 
 def main():
-    interval, out_dir, top_n, min_rss, min_cpu = read_env()
+    interval, out_dir, top_n, min_rss, min_cpu, gpu_interval = read_env()
     ensure_dir(out_dir)
 
     prev_ticks_map = {}
-    prev_time = time.time()
-
-    uid_map = load_uid_map()
+    # Monotonic clock: NTP steps must not skew CPU percent or the schedule.
+    prev_time = time.monotonic()
+    prev_pids: Set[int] = set()
+
+    gpu_enabled = GPU_METRICS_ENABLED and (
+        init_nvml()
+        # Containers may be given only some GPUs, e.g. just /dev/nvidia1.
+        or (
+            shutil.which("nvidia-smi") is not None
+            and bool(glob.glob("/dev/nvidia[0-9]*"))
+        )
+    )
+    if not gpu_enabled:
+        print("No NVIDIA GPU detected; GPU metrics disabled.", flush=True)
+    gpu_map: Dict[int, List[Dict[str, int]]] = {}
+
+    # Formatting and writing run on their own thread so a slow disk does not
+    # delay the next collection.
+    snapshots: "queue.Queue[Snapshot]" = queue.Queue(maxsize=1)
+    threading.Thread(
+        target=write_loop,
+        args=(snapshots, os.path.join(out_dir, "procstats.prom")),
+        daemon=True,
+    ).start()
 
     print(
         f"Starting procstat collector (Host-Procfs Mode). Reading from {PROCFS_PATH}. Interval: {interval}s",
         flush=True,
     )
 
+    next_deadline = time.monotonic()
+    next_gpu_poll = next_deadline
     while True:
-        loop_start = time.time()
-
         pids = get_process_pids()
 
         current_procs = []
         current_ticks_map = {}
-        now_time = time.time()
+        now_time = time.monotonic()
         time_delta = now_time - prev_time
         if time_delta <= 0:
             time_delta = 0.0001
 
-        for pid_str in pids:
-            info = get_process_info(pid_str, uid_map)
+        for info in collect_process_infos(pids, min_rss):
             if not info:
                 continue
 
-            pid = info["pid"]
-            current_ticks = info["cpu_ticks"]
+            pid = info.pid
+            start_time = info.start_time
+            current_ticks = info.cpu_ticks
 
+            # Entries are keyed by pid but only reused while the start time
+            # matches, so a recycled pid starts over instead of diffing
+            # against another process's ticks.
             cpu_percent = 0.0
-            if pid in prev_ticks_map:
-                delta_ticks = current_ticks - prev_ticks_map[pid]
+            prev = prev_ticks_map.get(pid)
+            if prev is not None and prev[0] == start_time:
+                delta_ticks = current_ticks - prev[1]
                 if delta_ticks >= 0:
                     cpu_seconds = delta_ticks / CLK_TCK
                     cpu_percent = (cpu_seconds / time_delta) * 100.0
 
-            current_ticks_map[pid] = current_ticks
-            info["cpu_percent"] = cpu_percent
+            current_ticks_map[pid] = (start_time, current_ticks)
+            info.cpu_percent = cpu_percent
 
+            # MIN_RSS_BYTES is applied by read_process_numbers().
             if min_cpu > 0 and cpu_percent < min_cpu:
                 continue
-            if min_rss > 0 and info["rss"] < min_rss:
-                continue
 
             current_procs.append(info)
 
         prev_ticks_map = current_ticks_map
         prev_time = now_time
 
-        gpu_map = collect_gpu_metrics()
-        lines = build_prom_lines(current_procs, gpu_map)
-        write_metrics(os.path.join(out_dir, "procstats.prom"), lines)
-
-        elapsed = time.time() - loop_start
-        wait_time = max(0.0, interval - elapsed)
-        time.sleep(wait_time)
+        # Keep per-PID state for PIDs seen in this scan or the previous one.
+        current_pids = {int(pid) for pid in pids}
+        prune_pid_caches(current_pids | prev_pids)
+        prev_pids = current_pids
+
+        if top_n > 0 and len(current_procs) > top_n:
+            current_procs = heapq.nlargest(top_n, current_procs, key=top_key)
+
+        # Names, users and fd counts are only looked up for what is emitted.
+        current_procs = resolve_identities(current_procs)
+
+        # GPU counters change slower than the process loop; reuse the last
+        # map between polls. Polls are scheduled against the tick, not the
+        # wake-up time, so sleep jitter cannot push one past its tick.
+        if gpu_enabled and next_gpu_poll < next_deadline + interval / 2:
+            gpu_map = collect_gpu_metrics(gpu_interval)
+            next_gpu_poll = max(
+                next_gpu_poll + gpu_interval, next_deadline + interval / 2
+            )
+        publish(snapshots, Snapshot(current_procs, gpu_map))
+
+        # Sleep until the next tick of a fixed schedule so the cadence does
+        # not drift; if a loop overran by more than an interval, restart it.
+        next_deadline += interval
+        now = time.monotonic()
+        if now - next_deadline > interval:
+            next_deadline = now
+        time.sleep(max(0.0, next_deadline - now))
 
 
 if __name__ == "__main__":